@@ -1,162 +1,387 @@
 """Browser manager using Playwright Python API for screenshots."""
 
 import asyncio
-import os
-import tempfile
-from typing import Optional
-from playwright.async_api import async_playwright, Browser, Page
+import logging
+import math
+import secrets
+from pathlib import Path
+from typing import Dict, List, Optional
+from playwright.async_api import async_playwright, Browser, Page, Route
+
+from app.imaging import JPEG_QUALITY
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bound of an xterm.js cell for 14px Courier New, used to size the
+# viewport to the terminal so Chromium composites as little as possible
+CELL_WIDTH = 9.6
+CELL_HEIGHT = 17
+VIEWPORT_MARGIN = 16
+
+# How long a screenshot waits for a pooled page before giving up
+PAGE_WAIT_TIMEOUT = 30
+
+BROWSER_ARGS = [
+    '--disable-dev-shm-usage',
+    '--disable-gpu',
+    '--no-sandbox',
+    '--disable-setuid-sandbox',
+    '--disable-software-rasterizer',
+    # Keep a renderer per page so pooled pages render in parallel;
+    # only trim what a server-side, single-origin browser never needs
+    '--disable-features=IsolateOrigins,site-per-process',
+    '--disable-background-networking',
+    '--disable-renderer-backgrounding',
+    '--disable-backgrounding-occluded-windows',
+    '--no-zygote',
+]
+
+
+class BrowserUnavailableError(RuntimeError):
+    """No pooled page became free in time, e.g. because the browsers crashed."""
+
+
+def _viewport_for(cols: int, rows: int) -> dict:
+    """Return a viewport just large enough for a cols x rows terminal."""
+    return {
+        "width": math.ceil(cols * CELL_WIDTH) + VIEWPORT_MARGIN,
+        "height": math.ceil(rows * CELL_HEIGHT) + VIEWPORT_MARGIN,
+    }
+
+
+# Pages fetch the terminal content from this URL; requests to it are
+# intercepted and fulfilled with the raw bytes, so the content is never
+# JSON-escaped into an evaluate() call. The .invalid TLD never resolves.
+CONTENT_URL = "http://tui-mcp.invalid/terminal-content/"
+CONTENT_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Content-Type": "application/octet-stream",
+}
+
+# Installed once in every pooled page: creates the page's xterm.js terminal
+# and window.__renderTerminal, so each screenshot only sends its arguments
+# over CDP and reuses the terminal instead of bootstrapping a new one
+RENDER_JS = """
+window.__term = new Terminal({
+    cursorBlink: true,
+    cursorStyle: 'block',
+    fontSize: 14,
+    fontFamily: 'Courier New, monospace',
+    theme: {
+        background: '#000000',
+        foreground: '#ffffff',
+        cursor: '#ffffff',
+    },
+    scrollback: 1000,
+    convertEol: true,
+    allowTransparency: false,
+    cols: 80,
+    rows: 24,
+});
+window.__term.open(document.getElementById('terminal'));
+
+window.__renderTerminal = ({ cols, rows, url }) => new Promise((resolve) => {
+    try {
+        const terminal = window.__term;
+        if (terminal.cols !== cols || terminal.rows !== rows) {
+            terminal.resize(cols, rows);
+        }
+
+        // The whole output is replayed from the start, so drop everything the
+        // previous screenshot left behind (buffer, modes, alternate screen)
+        terminal.reset();
+
+        // Fetch the raw UTF-8 bytes and hand them to xterm.js as-is;
+        // resolve once it has parsed the write and the following
+        // two frames guarantee it has been painted
+        fetch(url)
+            .then((response) => response.arrayBuffer())
+            .then((buffer) => {
+                terminal.write(new Uint8Array(buffer), () => {
+                    requestAnimationFrame(() => requestAnimationFrame(() => {
+                        resolve({ success: true, contentLength: buffer.byteLength });
+                    }));
+                });
+            })
+            .catch((error) => resolve({ success: false, error: error.message }));
+    } catch (error) {
+        resolve({ success: false, error: error.message });
+    }
+});
+"""
+
+STATIC_DIR = Path(__file__).resolve().parent.parent / "static"
+XTERM_CSS_TAG = '<link rel="stylesheet" href="/lib/xterm.css" />'
+XTERM_JS_TAG = '<script src="/lib/xterm.js"></script>'
+
+
+def _load_screenshot_template() -> str:
+    """Return the screenshot page with xterm.js and its stylesheet inlined.
+
+    Loading the page with ``set_content`` then needs no HTTP round-trip to
+    this server.
+    """
+    html = (STATIC_DIR / "terminal-screenshot.html").read_text()
+    css = (STATIC_DIR / "lib" / "xterm.css").read_text()
+    js = (STATIC_DIR / "lib" / "xterm.js").read_text()
+
+    if XTERM_CSS_TAG not in html or XTERM_JS_TAG not in html:
+        raise RuntimeError("terminal-screenshot.html does not reference the xterm.js assets")
+
+    # Keep a literal "</script" inside the bundle from closing the inline tag
+    js = js.replace("</script", "<\\/script")
+    return (
+        html
+        .replace(XTERM_CSS_TAG, f"<style>{css}</style>")
+        .replace(XTERM_JS_TAG, f"<script>{js}</script>")
+    )
 
 
 class BrowserManager:
     """Manages browser automation and screenshot capture using Playwright."""
     
-    def __init__(self, server_url: str = "http://localhost:8000"):
-        self.server_url = server_url
-        self.browser: Optional[Browser] = None
+    def __init__(
+        self,
+        browser_count: int = 4,
+        pages_per_browser: int = 2,
+    ):
+        # Chromium serializes screenshots per browser process, so capacity
+        # scales with the number of browsers rather than pages
+        self.browser_count = browser_count
+        self.pages_per_browser = pages_per_browser
+        self.browsers: List[Browser] = []
         self.page: Optional[Page] = None
         self.playwright = None
+        # Pre-warmed pages across all browsers, rented out one per screenshot
+        # and returned afterwards; whichever page is free first is used
+        self.pool_size = browser_count * pages_per_browser
+        self._page_pool: Optional[asyncio.Queue] = None
+        self._pool_lock = asyncio.Lock()
+        # Screenshot page with xterm.js inlined, read once on first warm-up
+        self._html: Optional[str] = None
+        # Terminal content awaiting pickup by a page, keyed by one-time token
+        self._pending: Dict[str, bytes] = {}
+        # Browsers relaunched after a crash, keyed by the browser they replaced
+        self._replacements: Dict[Browser, Browser] = {}
+        self._relaunch_lock = asyncio.Lock()
     
     async def start(self):
-        """Initialize browser manager (lazy initialization)."""
-        print("Browser manager initialized (lazy mode)")
+        """Start the browsers and pre-warm the page pool.
+
+        Pages are loaded with set_content and do not depend on the server
+        being up, so warming completes here and the first screenshot never
+        pays for browser launch.
+        """
+        await self._ensure_pool()
+        logger.info(
+            "Browser manager initialized (%d browsers x %d pages)",
+            self.browser_count, self.pages_per_browser,
+        )
     
     async def _ensure_browser(self):
-        """Ensure browser is started (lazy initialization)."""
-        if self.browser:
+        """Ensure the browsers are started (lazy initialization)."""
+        if self.browsers:
             return  # Already initialized
 
         try:
             # Start Playwright
-            self.playwright = await async_playwright().start()
-
-            # Launch browser
-            self.browser = await self.playwright.chromium.launch(
-                headless=True,
-                args=[
-                    '--disable-dev-shm-usage',
-                    '--disable-gpu',
-                    '--no-sandbox',
-                    '--disable-setuid-sandbox',
-                    '--disable-software-rasterizer',
-                    '--single-process',  # Prevent multi-process crashes
-                ]
-            )
+            if not self.playwright:
+                self.playwright = await async_playwright().start()
 
-            print("Browser initialized")
+            # Launch independent browser processes concurrently
+            self.browsers = list(await asyncio.gather(*[
+                self._launch_browser() for _ in range(self.browser_count)
+            ]))
+
+            logger.info("%d browsers initialized", len(self.browsers))
 
         except Exception as e:
-            print(f"Error starting browser: {e}")
+            logger.error("Error starting browser: %s", e)
             raise
+
+    async def _launch_browser(self) -> Browser:
+        """Launch one headless Chromium process."""
+        return await self.playwright.chromium.launch(headless=True, args=BROWSER_ARGS)
+
+    async def _relaunch_browser(self, browser: Browser) -> Browser:
+        """Replace a crashed browser, once, and return its replacement."""
+        async with self._relaunch_lock:
+            # Follow earlier relaunches, so every page of a crashed browser
+            # lands on the same replacement
+            while browser in self._replacements:
+                browser = self._replacements[browser]
+            if browser.is_connected():
+                return browser
+
+            replacement = await self._launch_browser()
+            self._replacements[browser] = replacement
+            if browser in self.browsers:
+                self.browsers[self.browsers.index(browser)] = replacement
+            logger.warning("Browser disconnected, relaunched it")
+            return replacement
+
+    async def _ensure_pool(self):
+        """Ensure the browser is started and the page pool is filled."""
+        async with self._pool_lock:
+            if self._page_pool is not None:
+                return  # Already warmed
+
+            if self._html is None:
+                self._html = _load_screenshot_template()
+
+            await self._ensure_browser()
+
+            # Interleave pages so consecutive rentals land on different browsers
+            pool: asyncio.Queue = asyncio.Queue(maxsize=self.pool_size)
+            for _ in range(self.pages_per_browser):
+                pages = await asyncio.gather(*[
+                    self._new_page(browser) for browser in self.browsers
+                ])
+                for page in pages:
+                    await pool.put(page)
+            self._page_pool = pool
+
+    async def _new_page(self, browser: Browser) -> Page:
+        """Create a page with the screenshot template loaded and xterm.js ready."""
+        page = await browser.new_page(viewport=_viewport_for(80, 24))
+        await page.route(f"{CONTENT_URL}*", self._fulfill_content)
+        await page.set_content(self._html, wait_until="load")
+        await page.wait_for_function("typeof Terminal !== 'undefined'", timeout=5000)
+        await page.add_script_tag(content=RENDER_JS)
+        return page
+
+    async def _fulfill_content(self, route: Route):
+        """Answer a page's content fetch with the pending bytes for its token."""
+        token = route.request.url[len(CONTENT_URL):]
+        content = self._pending.pop(token, None)
+
+        if content is None:
+            await route.fulfill(status=404, headers=CONTENT_HEADERS, body=b"")
+        else:
+            await route.fulfill(status=200, headers=CONTENT_HEADERS, body=content)
+
+    async def _recycle_page(self, page: Page):
+        """Replace a page that failed mid-render with a freshly warmed one.
+
+        If its browser has crashed, the browser is relaunched first, so the
+        pool keeps its size.
+        """
+        browser = page.context.browser
+
+        try:
+            await page.close()
+        except Exception:
+            pass
+
+        try:
+            try:
+                new_page = await self._new_page(browser)
+            except Exception:
+                if browser.is_connected():
+                    raise
+                new_page = await self._new_page(await self._relaunch_browser(browser))
+            await self._page_pool.put(new_page)
+        except Exception as e:
+            logger.error("Error replacing pooled page: %s", e)
     
     async def stop(self):
         """Stop the browser."""
-        if self.browser:
+        # Pooled pages are closed along with the browser
+        self._page_pool = None
+
+        for browser in self.browsers:
             try:
-                await self.browser.close()
+                await browser.close()
             except Exception as e:
-                print(f"Error closing browser: {e}")
+                logger.warning("Error closing browser: %s", e)
+        self.browsers = []
+        self._replacements.clear()
 
         if self.playwright:
             try:
                 await self.playwright.stop()
             except Exception as e:
-                print(f"Error stopping playwright: {e}")
+                logger.warning("Error stopping playwright: %s", e)
 
-        print("Browser stopped")
+        logger.info("Browser stopped")
     
-    async def take_screenshot(self, terminal_content: str, cols: int = 80, rows: int = 24) -> str:
+    async def take_screenshot(
+        self,
+        terminal_content: str,
+        cols: int = 80,
+        rows: int = 24,
+        image_format: str = "png",
+    ) -> bytes:
         """Take a screenshot of the terminal with injected content.
 
         Args:
             terminal_content: The terminal output to render
             cols: Number of columns
             rows: Number of rows
+            image_format: Image encoding, "png" or "jpeg"
 
         Returns:
-            Path to the screenshot file
+            The encoded screenshot image
+
+        Raises:
+            BrowserUnavailableError: No pooled page became free in time
         """
-        # Ensure browser is initialized
-        await self._ensure_browser()
+        # Ensure the browser and page pool are ready
+        await self._ensure_pool()
+
+        # Rent a pre-warmed page; it goes back to the pool once the screenshot is taken
+        try:
+            page = await asyncio.wait_for(self._page_pool.get(), timeout=PAGE_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise BrowserUnavailableError(f"No browser page became free within {PAGE_WAIT_TIMEOUT}s") from None
+        healthy = False
 
-        if not self.browser:
-            raise RuntimeError("Browser not initialized")
+        token = secrets.token_urlsafe(8)
+        self._pending[token] = terminal_content.encode("utf-8", errors="replace")
 
         try:
-            # Create a new page for this screenshot
-            page = await self.browser.new_page(
-                viewport={"width": 1024, "height": 768}
+            viewport = _viewport_for(cols, rows)
+            if page.viewport_size != viewport:
+                await page.set_viewport_size(viewport)
+
+            # Reset the page's terminal and write content in a single call to the installed render function;
+            # the returned promise settles only after the content has been rendered
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Initializing terminal (%dx%d) and writing %d bytes: %r",
+                    cols, rows, len(terminal_content), terminal_content[:100],
+                )
+
+            result = await page.evaluate(
+                "args => window.__renderTerminal(args)",
+                {"cols": cols, "rows": rows, "url": f"{CONTENT_URL}{token}"},
             )
 
-            try:
-                # Navigate to the screenshot page
-                print(f"Navigating to {self.server_url}/static/terminal-screenshot.html")
-                await page.goto(f"{self.server_url}/static/terminal-screenshot.html", wait_until="load")
-
-                # Wait for xterm.js to load and initialize terminal in one call
-                print("Waiting for Terminal class and initializing...")
-                await page.wait_for_function("typeof Terminal !== 'undefined'", timeout=5000)
-                print("Terminal class loaded")
-
-                # Initialize and write content in a single evaluate call to avoid multiple round-trips
-                print(f"Initializing terminal ({cols}x{rows}) and writing {len(terminal_content)} bytes")
-                print(f"Content preview: {repr(terminal_content[:100] if terminal_content else '')}")
-
-                result = await page.evaluate("""
-                    ({ cols, rows, content }) => {
-                        try {
-                            // Initialize terminal
-                            const terminal = new Terminal({
-                                cursorBlink: true,
-                                cursorStyle: 'block',
-                                fontSize: 14,
-                                fontFamily: 'Courier New, monospace',
-                                theme: {
-                                    background: '#000000',
-                                    foreground: '#ffffff',
-                                    cursor: '#ffffff',
-                                },
-                                scrollback: 1000,
-                                convertEol: true,
-                                allowTransparency: false,
-                                cols: cols,
-                                rows: rows,
-                            });
-
-                            const container = document.getElementById('terminal');
-                            terminal.open(container);
-
-                            // Write content if provided
-                            if (content) {
-                                terminal.write(content);
-                            }
-
-                            return { success: true, contentLength: content ? content.length : 0 };
-                        } catch (error) {
-                            return { success: false, error: error.message };
-                        }
-                    }
-                """, {"cols": cols, "rows": rows, "content": terminal_content})
-
-                print(f"Result: {result}")
-                if not result.get("success"):
-                    raise RuntimeError(f"Terminal initialization failed: {result.get('error')}")
-
-                # Small delay to ensure rendering is complete
-                await asyncio.sleep(0.5)
-
-                # Take screenshot
-                with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
-                    screenshot_path = f.name
-
-                await page.screenshot(path=screenshot_path)
-
-                print(f"Screenshot saved to {screenshot_path}")
-                return screenshot_path
-
-            finally:
-                # Always close the page
-                await page.close()
+            logger.debug("Result: %s", result)
+            if not result.get("success"):
+                raise RuntimeError(f"Terminal initialization failed: {result.get('error')}")
+
+            # Capture only the terminal element, straight into memory
+            terminal_element = page.locator("#terminal")
+            if image_format == "jpeg":
+                image = await terminal_element.screenshot(type="jpeg", quality=JPEG_QUALITY)
+            else:
+                image = await terminal_element.screenshot(type="png")
+            healthy = True
+
+            logger.debug("Screenshot captured (%d bytes)", len(image))
+            return image
 
         except Exception as e:
-            print(f"Error taking screenshot: {e}")
+            logger.error("Error taking screenshot: %s", e)
             raise
+
+        finally:
+            self._pending.pop(token, None)
+
+            # Return the page to the pool, or swap it out if the render failed
+            if healthy:
+                await self._page_pool.put(page)
+            else:
+                await self._recycle_page(page)
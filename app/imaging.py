@@ -0,0 +1,27 @@
+"""Image encoding settings and font loading shared by the screenshot renderers."""
+
+import functools
+from typing import Optional
+
+from PIL import ImageFont
+
+
+# Quality of JPEG screenshots (format=jpeg), whichever renderer produces them
+JPEG_QUALITY = 80
+
+FONT_NAME = "DejaVuSansMono.ttf"
+BOLD_FONT_NAME = "DejaVuSansMono-Bold.ttf"
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(name: str, size: int) -> Optional[ImageFont.FreeTypeFont]:
+    """Load a TrueType font by file name, searching the system font directories.
+
+    Terminal cells are drawn without shaping, so the basic layout engine is
+    used and raqm is skipped. Each font is searched for and loaded once.
+    Returns None if the font is not installed.
+    """
+    try:
+        return ImageFont.truetype(name, size, layout_engine=ImageFont.Layout.BASIC)
+    except OSError:
+        return None
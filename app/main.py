@@ -1,4 +1,7 @@
 #!/usr/bin/env python3
+import asyncio
+import hashlib
+import logging
 import os
 import pty
 import subprocess
@@ -7,53 +10,183 @@ import fcntl
 import struct
 import termios
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Literal, Optional, Tuple
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, StreamingResponse
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.types import Message, Receive, Scope, Send
 from pydantic import BaseModel
 import uvicorn
+import xxhash
 
 from app.terminal_manager import TerminalManager
-from app.browser_manager import BrowserManager
+from app.browser_manager import BrowserManager, BrowserUnavailableError
+from app.pyte_renderer import PyteRenderer, ScreenSnapshot
 
 
+# Application logging is quiet by default; set TUI_MCP_LOG=INFO (or DEBUG)
+# for startup and per-request detail. Configured at import so it also applies
+# when the app is launched through the uvicorn CLI.
+logging.basicConfig(
+    level=os.environ.get("TUI_MCP_LOG", "WARNING").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# Screenshots are rendered in-process with pyte + Pillow by default; set
+# TUI_MCP_RENDERER=browser to render through Playwright + Xterm.js instead
+SCREENSHOT_RENDERER = os.environ.get("TUI_MCP_RENDERER", "pyte")
+
 # Global instances
 terminal_manager: Optional[TerminalManager] = None
 browser_manager: Optional[BrowserManager] = None
+pyte_renderer: Optional[PyteRenderer] = None
+
+# Bounds concurrent screenshots to the renderer's capacity so excess requests
+# queue fairly here; for the browser this avoids thrashing Chromium's
+# screenshot queue, and pyte rendering is CPU-bound under the GIL
+screenshot_semaphore: Optional[asyncio.Semaphore] = None
+screenshot_waiting = 0
+
+# WebSocket client frames are binary: one opcode byte followed by the payload.
+# Input carries UTF-8 keystrokes; resize carries cols and rows as big-endian uint16.
+WS_OP_INPUT = 0
+WS_OP_RESIZE = 1
+
+SCREENSHOT_MEDIA_TYPES = {
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+}
+
+# Most recent screenshot as (ETag, image); polls of an unchanged terminal
+# are answered from here without touching the browser
+last_screenshot: Optional[Tuple[str, bytes]] = None
+
+# Hot static assets (xterm.js and its stylesheet, loaded by the terminal page
+# at / on every visit), read once at startup and served from memory instead of
+# going through StaticFiles per request. Pooled browser pages have xterm.js
+# inlined and request nothing from the server.
+STATIC_DIR = Path("static")
+CACHED_STATIC_FILES = {
+    "lib/xterm.js": "application/javascript",
+    "lib/xterm.css": "text/css",
+}
+STATIC_CACHE: Dict[str, Tuple[bytes, str, str]] = {}
+
+
+def load_static_cache():
+    """Read the hot static assets into memory, keyed by their path under static/."""
+    STATIC_CACHE.clear()
+    for name, media_type in CACHED_STATIC_FILES.items():
+        path = STATIC_DIR / name
+        if not path.is_file():
+            logger.warning("Static asset not found, not cached: %s", path)
+            continue
+        content = path.read_bytes()
+        etag = f'"{hashlib.sha1(content).hexdigest()[:16]}"'
+        STATIC_CACHE[name] = (content, media_type, etag)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage application startup and shutdown."""
-    global terminal_manager, browser_manager
+    global terminal_manager, browser_manager, pyte_renderer, screenshot_semaphore
     
     # Startup
-    print("Starting TUI MCP Server...")
-    terminal_manager = TerminalManager()
+    logger.info("Starting TUI MCP Server...")
+    load_static_cache()
+
+    terminal_manager = TerminalManager(emulate_screen=SCREENSHOT_RENDERER != "browser")
     await terminal_manager.start()
     
-    browser_manager = BrowserManager()
-    await browser_manager.start()
+    if SCREENSHOT_RENDERER == "browser":
+        browser_manager = BrowserManager()
+        await browser_manager.start()
+        screenshot_semaphore = asyncio.Semaphore(browser_manager.pool_size)
+    else:
+        pyte_renderer = PyteRenderer()
+        screenshot_semaphore = asyncio.Semaphore(1)
     
-    print("Server started successfully")
+    logger.info("Server started successfully")
     yield
     
     # Shutdown
-    print("Shutting down TUI MCP Server...")
+    logger.info("Shutting down TUI MCP Server...")
     if terminal_manager:
         await terminal_manager.stop()
     if browser_manager:
         await browser_manager.stop()
-    print("Server shut down")
+    logger.info("Server shut down")
+
+
+class ImagePassthroughGZipResponder(GZipResponder):
+    """GZipResponder that passes image responses through uncompressed."""
+
+    async def send_with_gzip(self, message: Message) -> None:
+        await super().send_with_gzip(message)
+        if message["type"] == "http.response.start":
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            if content_type.startswith("image/"):
+                # PNG and JPEG are already compressed; take the same path as a
+                # response that sets its own Content-Encoding
+                self.content_encoding_set = True
+
+
+class ImagePassthroughGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware that leaves image responses, such as screenshots, alone."""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = ImagePassthroughGZipResponder(
+                self.app, self.minimum_size, compresslevel=self.compresslevel
+            )
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
 
 
 # Create the FastAPI app
 app = FastAPI(lifespan=lifespan)
 
-# Mount static files
+# Compress JSON and text static assets for clients that accept gzip. Images
+# are already compressed and sent as they are, and small responses are left
+# alone since compressing them costs more than it saves.
+app.add_middleware(ImagePassthroughGZipMiddleware, minimum_size=500, compresslevel=5)
+
+
+def cached_static_response(request: Request, name: str) -> Response:
+    """Serve a cached static asset with a strong ETag."""
+    cached = STATIC_CACHE.get(name)
+    if cached is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    content, media_type, etag = cached
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": etag,
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
+# Cached routes, at the paths static/index.html uses, are registered before
+# the mounts below so they take precedence
+@app.get("/static/lib/xterm.js", include_in_schema=False)
+async def static_xterm_js(request: Request):
+    return cached_static_response(request, "lib/xterm.js")
+
+
+@app.get("/static/lib/xterm.css", include_in_schema=False)
+async def static_xterm_css(request: Request):
+    return cached_static_response(request, "lib/xterm.css")
+
+
+# Mount static files (fallback for everything not cached above)
 app.mount("/lib", StaticFiles(directory="static/lib"), name="lib")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -69,39 +202,36 @@ async def websocket_endpoint(websocket: WebSocket):
     
     # Register the WebSocket connection
     connection_id = terminal_manager.add_connection(websocket)
-    print(f"WebSocket connection registered: {connection_id}")
+    logger.info("WebSocket connection registered: %s", connection_id)
     
     try:
         # Keep the connection open and handle incoming data
         while True:
             try:
                 # Receive data from the client (with timeout to allow graceful shutdown)
-                import asyncio
-                data = await asyncio.wait_for(websocket.receive_text(), timeout=60.0)
-                
-                # Check if it's a resize message
-                if data.startswith('{"type":"resize"'):
-                    import json
-                    try:
-                        msg = json.loads(data)
-                        cols = msg.get('cols', 80)
-                        rows = msg.get('rows', 24)
+                data = await asyncio.wait_for(websocket.receive_bytes(), timeout=60.0)
+                if not data:
+                    continue
+
+                opcode = data[0]
+                if opcode == WS_OP_RESIZE:
+                    if len(data) >= 5:
+                        cols = int.from_bytes(data[1:3], 'big')
+                        rows = int.from_bytes(data[3:5], 'big')
                         terminal_manager.resize_pty(cols, rows)
-                    except json.JSONDecodeError:
-                        pass
-                else:
+                elif opcode == WS_OP_INPUT:
                     # Send regular input to the PTY
-                    await terminal_manager.write_to_pty(data)
+                    await terminal_manager.write_to_pty(data[1:].decode('utf-8', errors='replace'))
             except asyncio.TimeoutError:
                 # Timeout is OK, just continue the loop
                 continue
     
     except WebSocketDisconnect:
-        print(f"WebSocket disconnected: {connection_id}")
-        terminal_manager.remove_connection(connection_id)
+        logger.info("WebSocket disconnected: %s", connection_id)
+        terminal_manager.remove_connection(websocket)
     except Exception as e:
-        print(f"WebSocket error: {e}")
-        terminal_manager.remove_connection(connection_id)
+        logger.warning("WebSocket error: %s", e)
+        terminal_manager.remove_connection(websocket)
 
 
 @app.get("/")
@@ -116,7 +246,9 @@ async def health():
     return {
         "status": "healthy",
         "terminal_ready": terminal_manager is not None,
-        "browser_ready": browser_manager is not None
+        "browser_ready": browser_manager is not None,
+        "renderer": SCREENSHOT_RENDERER,
+        "screenshots_waiting": screenshot_waiting,
     }
 
 
@@ -162,31 +294,89 @@ async def mcp_wait_for_stable_output(request: WaitRequest):
     return {"status": "output is stable"}
 
 
+def screenshot_etag(terminal_content: str, cols: int, rows: int, image_format: str) -> str:
+    """Return an ETag identifying the screenshot of this terminal state."""
+    digest = xxhash.xxh3_64(terminal_content.encode("utf-8", errors="replace"))
+    digest.update(f"{cols}x{rows}.{image_format}".encode())
+    return f'"{digest.hexdigest()}"'
+
+
+def snapshot_etag(snapshot: ScreenSnapshot, image_format: str) -> str:
+    """Return an ETag identifying the screenshot of this screen snapshot.
+
+    Snapshots are hashed with hash(), which is only stable within one process;
+    after a restart clients just miss the cache once.
+    """
+    return f'"{hash(snapshot) & 0xFFFFFFFFFFFFFFFF:016x}.{image_format}"'
+
+
+def cached_screenshot(request: Request, etag: str, image_format: str) -> Optional[Response]:
+    """Answer from the client's or the server's cache when the screenshot has not changed."""
+    headers = {"ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    if last_screenshot and last_screenshot[0] == etag:
+        return Response(content=last_screenshot[1], media_type=SCREENSHOT_MEDIA_TYPES[image_format], headers=headers)
+    return None
+
+
 @app.get("/mcp/screenshot")
-async def mcp_screenshot():
-    """Take a screenshot of the terminal."""
-    if not browser_manager:
-        raise HTTPException(status_code=503, detail="Browser manager not initialized")
+async def mcp_screenshot(request: Request, format: Literal["jpeg", "png"] = "png"):
+    """Take a screenshot of the terminal (PNG by default, JPEG on request)."""
+    global screenshot_waiting, last_screenshot
+
+    if not screenshot_semaphore:
+        raise HTTPException(status_code=503, detail="Screenshot renderer not initialized")
 
     if not terminal_manager:
         raise HTTPException(status_code=503, detail="Terminal manager not initialized")
 
-    # Get the buffered terminal content
-    terminal_content = terminal_manager.get_output_content()
-
     # Get terminal dimensions
     cols = terminal_manager.cols
     rows = terminal_manager.rows
 
-    # Take screenshot with the content
-    screenshot_path = await browser_manager.take_screenshot(terminal_content, cols, rows)
+    if browser_manager:
+        # The browser replays the buffered output from the start
+        terminal_content = terminal_manager.get_output_content()
+        etag = screenshot_etag(terminal_content, cols, rows, format)
+        cached = cached_screenshot(request, etag, format)
+        if cached is not None:
+            return cached
+
+    screenshot_waiting += 1
+    try:
+        await screenshot_semaphore.acquire()
+    finally:
+        screenshot_waiting -= 1
 
-    if not screenshot_path or not os.path.exists(screenshot_path):
+    try:
+        # Take screenshot with the content
+        if browser_manager:
+            image = await browser_manager.take_screenshot(terminal_content, cols, rows, format)
+        else:
+            # Bring the emulated screen up to date with the output that arrived
+            # since the last screenshot, off the event loop, and render it
+            # unless it has not changed
+            backlog = terminal_manager.screen_backlog()
+            snapshot = await asyncio.to_thread(terminal_manager.update_screen, backlog)
+            etag = snapshot_etag(snapshot, format)
+            cached = cached_screenshot(request, etag, format)
+            if cached is not None:
+                return cached
+            image = await asyncio.to_thread(pyte_renderer.render, snapshot, format)
+    except BrowserUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    finally:
+        screenshot_semaphore.release()
+
+    if not image:
         raise HTTPException(status_code=500, detail="Failed to take screenshot")
 
-    # Return the screenshot as a PNG file
-    return FileResponse(screenshot_path, media_type="image/png")
+    last_screenshot = (etag, image)
+
+    # Return the screenshot bytes directly, without a round-trip through disk
+    return Response(content=image, media_type=SCREENSHOT_MEDIA_TYPES[format], headers={"ETag": etag})
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools", ws="websockets")
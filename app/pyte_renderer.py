@@ -0,0 +1,248 @@
+"""Render terminal output to images with pyte and Pillow, without a browser."""
+
+import io
+import itertools
+import logging
+import math
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import pyte
+from pyte.screens import Char
+from PIL import Image, ImageDraw, ImageFont
+from wcwidth import wcwidth
+
+from app.imaging import BOLD_FONT_NAME, FONT_NAME, JPEG_QUALITY, load_font
+
+
+logger = logging.getLogger(__name__)
+
+Color = Tuple[int, int, int]
+
+# Same theme as the xterm.js screenshot page
+DEFAULT_FG: Color = (255, 255, 255)
+DEFAULT_BG: Color = (0, 0, 0)
+CURSOR_COLOR: Color = (255, 255, 255)
+
+# xterm.js default palette, keyed by pyte's colour names; 256-colour and
+# true-colour attributes arrive from pyte as "rrggbb" hex strings instead
+ANSI_COLORS: Dict[str, Color] = {
+    "black": (0x2e, 0x34, 0x36),
+    "red": (0xcc, 0x00, 0x00),
+    "green": (0x4e, 0x9a, 0x06),
+    "brown": (0xc4, 0xa0, 0x00),
+    "blue": (0x34, 0x65, 0xa4),
+    "magenta": (0x75, 0x50, 0x7b),
+    "cyan": (0x06, 0x98, 0x9a),
+    "white": (0xd3, 0xd7, 0xcf),
+    "brightblack": (0x55, 0x57, 0x53),
+    "brightred": (0xef, 0x29, 0x29),
+    "brightgreen": (0x8a, 0xe2, 0x34),
+    "brightbrown": (0xfc, 0xe9, 0x4f),
+    "brightblue": (0x72, 0x9f, 0xcf),
+    "brightmagenta": (0xad, 0x7f, 0xa8),
+    "brightcyan": (0x34, 0xe2, 0xe2),
+    "brightwhite": (0xee, 0xee, 0xec),
+}
+
+
+# xterm's private modes that switch to the alternate screen buffer; 1049 also
+# saves the cursor on entry and restores it on exit
+ALT_SCREEN_MODES = frozenset({47, 1047, 1049})
+
+
+class ScreenSnapshot(NamedTuple):
+    """A copy of a screen's cells and cursor, safe to render off the event loop."""
+
+    lines: Tuple[Tuple[Char, ...], ...]
+    # (x, y), or None while the cursor is hidden
+    cursor: Optional[Tuple[int, int]]
+
+
+class TerminalScreen(pyte.Screen):
+    """pyte screen that also implements the alternate screen buffer.
+
+    pyte ignores the alternate screen modes, so a full-screen app that has
+    exited would otherwise stay on screen instead of the shell it ran from.
+    """
+
+    def __init__(self, columns: int, lines: int):
+        # The main screen's buffer, set aside while the alternate screen is shown
+        self._main_buffer = None
+        super().__init__(columns, lines)
+        # Match xterm.js convertEol: a bare LF also returns the carriage
+        self.set_mode(pyte.modes.LNM)
+
+    def reset(self):
+        super().reset()
+        self._main_buffer = None
+
+    def set_mode(self, *modes: int, **kwargs):
+        if kwargs.get("private") and ALT_SCREEN_MODES.intersection(modes):
+            self._enter_alternate_screen(save_cursor=1049 in modes)
+            modes = tuple(mode for mode in modes if mode not in ALT_SCREEN_MODES)
+        super().set_mode(*modes, **kwargs)
+
+    def reset_mode(self, *modes: int, **kwargs):
+        if kwargs.get("private") and ALT_SCREEN_MODES.intersection(modes):
+            self._exit_alternate_screen(restore_cursor=1049 in modes)
+            modes = tuple(mode for mode in modes if mode not in ALT_SCREEN_MODES)
+        super().reset_mode(*modes, **kwargs)
+
+    def snapshot(self) -> ScreenSnapshot:
+        """Copy the visible cells and the cursor position."""
+        lines = tuple(
+            tuple(self.buffer[y][x] for x in range(self.columns))
+            for y in range(self.lines)
+        )
+        cursor = self.cursor
+        visible = not cursor.hidden and cursor.x < self.columns and cursor.y < self.lines
+        return ScreenSnapshot(lines, (cursor.x, cursor.y) if visible else None)
+
+    def _enter_alternate_screen(self, save_cursor: bool):
+        """Set the main buffer aside and show a blank one."""
+        if self._main_buffer is not None:
+            return
+        if save_cursor:
+            self.save_cursor()
+        self._main_buffer = self.buffer
+        self.buffer = type(self.buffer)(self.buffer.default_factory)
+        self.dirty.update(range(self.lines))
+
+    def _exit_alternate_screen(self, restore_cursor: bool):
+        """Drop the alternate buffer and show the main one again."""
+        if self._main_buffer is None:
+            return
+        self.buffer = self._main_buffer
+        self._main_buffer = None
+        if restore_cursor:
+            self.restore_cursor()
+        self.dirty.update(range(self.lines))
+
+
+def _is_narrow(data: str) -> bool:
+    """Whether a cell holds exactly one single-width character.
+
+    Wide characters take two cells, the second holding "", and combining
+    characters share a cell with their base, so runs of such cells cannot be
+    drawn as one string.
+    """
+    return len(data) == 1 and (data.isascii() or wcwidth(data) == 1)
+
+
+class PyteRenderer:
+    """Renders snapshots of a TerminalScreen, pyte's VT100 emulator, to images."""
+
+    def __init__(self, font_size: int = 14):
+        self.font_size = font_size
+
+        self.font = load_font(FONT_NAME, font_size)
+        if self.font is None:
+            logger.warning("Font %s not found, falling back to Pillow's default font", FONT_NAME)
+            self.font = ImageFont.load_default(size=font_size)
+        self.bold_font = load_font(BOLD_FONT_NAME, font_size) or self.font
+
+        # Cell size comes from the font so whole runs of text can be drawn
+        # in one call and still land on the cell grid
+        self.cell_width = self.font.getlength("M")
+        ascent, descent = self.font.getmetrics()
+        self.cell_height = ascent + descent
+
+    def render(self, snapshot: ScreenSnapshot, image_format: str = "png") -> bytes:
+        """Render a screen snapshot and return the encoded image.
+
+        Args:
+            snapshot: The screen to draw, from TerminalScreen.snapshot()
+            image_format: Image encoding, "png" or "jpeg"
+        """
+        rows = len(snapshot.lines)
+        cols = len(snapshot.lines[0])
+
+        width = math.ceil(cols * self.cell_width)
+        height = rows * self.cell_height
+        image = Image.new("RGB", (width, height), DEFAULT_BG)
+        draw = ImageDraw.Draw(image)
+
+        for row, line in enumerate(snapshot.lines):
+            self._draw_line(draw, line, row, cols)
+        self._draw_cursor(draw, snapshot)
+
+        buf = io.BytesIO()
+        if image_format == "jpeg":
+            image.save(buf, "JPEG", quality=JPEG_QUALITY)
+        else:
+            image.save(buf, "PNG", optimize=False)
+        return buf.getvalue()
+
+    def _draw_line(self, draw: ImageDraw.ImageDraw, line, row: int, cols: int):
+        """Draw one screen line as runs of cells sharing the same colours and weight.
+
+        Runs of narrow characters are drawn as one string; other cells are
+        drawn one by one at their own column, so they stay on the cell grid.
+        """
+        top = row * self.cell_height
+        bottom = top + self.cell_height - 1
+
+        runs = itertools.groupby(
+            range(cols), key=lambda col: self._style(line[col]) + (_is_narrow(line[col].data),)
+        )
+        for (fg, bg, bold, narrow), run in runs:
+            run = list(run)
+            left = round(run[0] * self.cell_width)
+            font = self.bold_font if bold else self.font
+
+            if bg != DEFAULT_BG:
+                right = round((run[-1] + 1) * self.cell_width) - 1
+                draw.rectangle([left, top, right, bottom], fill=bg)
+
+            if narrow:
+                text = "".join(line[col].data for col in run)
+                if text.strip():
+                    draw.text((left, top), text, fill=fg, font=font)
+                continue
+
+            for col in run:
+                data = line[col].data
+                if data.strip():
+                    draw.text((round(col * self.cell_width), top), data, fill=fg, font=font)
+
+    def _draw_cursor(self, draw: ImageDraw.ImageDraw, snapshot: ScreenSnapshot):
+        """Draw a block cursor, as the xterm.js page does."""
+        if snapshot.cursor is None:
+            return
+
+        x, y = snapshot.cursor
+        left = round(x * self.cell_width)
+        top = y * self.cell_height
+        right = round((x + 1) * self.cell_width) - 1
+        draw.rectangle([left, top, right, top + self.cell_height - 1], fill=CURSOR_COLOR)
+
+        char = snapshot.lines[y][x].data
+        if char.strip():
+            draw.text((left, top), char, fill=DEFAULT_BG, font=self.font)
+
+    def _style(self, char) -> Tuple[Color, Color, bool]:
+        """Resolve a pyte character's attributes to (foreground, background, bold)."""
+        fg = self._color(char.fg, DEFAULT_FG, bright=char.bold)
+        bg = self._color(char.bg, DEFAULT_BG)
+        if char.reverse:
+            fg, bg = bg, fg
+        return fg, bg, char.bold
+
+    @staticmethod
+    def _color(name: str, default: Color, bright: bool = False) -> Color:
+        """Resolve a pyte colour name or hex string to RGB."""
+        if name == "default":
+            return default
+
+        # Like xterm.js, bold text in one of the eight base colours is drawn bright
+        if bright and "bright" + name in ANSI_COLORS:
+            name = "bright" + name
+
+        color = ANSI_COLORS.get(name)
+        if color is not None:
+            return color
+
+        try:
+            return (int(name[0:2], 16), int(name[2:4], 16), int(name[4:6], 16))
+        except ValueError:
+            return default
@@ -1,13 +1,23 @@
-"""Render terminal output to PNG screenshots."""
+"""Render terminal output to PNG or JPEG screenshots."""
 
 from PIL import Image, ImageDraw, ImageFont
-from typing import List
+from typing import List, Optional
+import io
+import math
+import numpy as np
 import os
 import tempfile
+import xxhash
+
+from app.imaging import FONT_NAME, JPEG_QUALITY, load_font
 
 
 class ScreenshotRenderer:
-    """Renders terminal output to PNG images."""
+    """Renders terminal output to PNG or JPEG images.
+
+    The framebuffer is reused between renders, so an instance must not render
+    from several threads at once.
+    """
     
     def __init__(self, cols: int = 80, rows: int = 24):
         self.cols = cols
@@ -15,9 +25,7 @@ class ScreenshotRenderer:
         
         # Font settings
         self.font_size = 14
-        self.font_name = "DejaVuSansMono.ttf"
-        self.char_width = 8
-        self.char_height = 16
+        self.font_name = FONT_NAME
         self.line_spacing = 2
         
         # Colors
@@ -26,41 +34,154 @@ class ScreenshotRenderer:
         self.cursor_color = (255, 255, 255)  # White
         
         # Try to load the font
-        try:
-            self.font = ImageFont.truetype(f"/usr/share/fonts/truetype/dejavu/{self.font_name}", self.font_size)
-        except Exception:
+        self.font = load_font(FONT_NAME, self.font_size)
+        if self.font is None:
             # Fallback to default font
-            self.font = ImageFont.load_default()
+            self.font = ImageFont.load_default(size=self.font_size)
+        
+        # Cell size comes from the font actually loaded, so glyphs stay on the
+        # grid whichever font that is
+        self.char_width = math.ceil(self.font.getlength("M"))
+        if hasattr(self.font, "getmetrics"):
+            ascent, descent = self.font.getmetrics()
+            self.char_height = ascent + descent
+        else:
+            self.char_height = self.font.getbbox("Mg")[3]
+        
+        # Printable ASCII rasterized once, indexed by character code, so renders
+        # copy cells instead of running every glyph through FreeType again
+        self._glyphs: np.ndarray = self._build_atlas()
+        
+        # Framebuffer reused across renders; rebuilt only when the dimensions change.
+        # _prev_buffer holds the lines currently drawn in it, one per row, and
+        # _row_ys/_col_xs the pixel offsets of every row and column that fits.
+        self._fb: Optional[np.ndarray] = None
+        self._prev_buffer: List[str] = []
+        self._row_ys: List[int] = []
+        self._col_xs: List[int] = []
+        self._ensure_framebuffer()
+        
+        # Hash of the last rendered buffer, size and format and the image it produced
+        self._last_hash: Optional[int] = None
+        self._last_image: bytes = b""
     
-    def render(self, buffer: List[str]) -> str:
-        """Render the terminal buffer to a PNG image and return the path."""
-        # Calculate image dimensions
+    def _build_atlas(self) -> np.ndarray:
+        """Rasterize ASCII into one strip and return it as a (128, cell_h, cell_w, 3) array.
+
+        Control characters, space and DEL are left as blank cells.
+        """
+        cell_w = self.char_width
+        cell_h = self.char_height + self.line_spacing
+        atlas = Image.new('RGB', (128 * cell_w, cell_h), color=self.bg_color)
+        draw = ImageDraw.Draw(atlas)
+        
+        for code in range(33, 127):
+            draw.text((code * cell_w, 0), chr(code), fill=self.fg_color, font=self.font)
+        
+        strip = np.asarray(atlas, dtype=np.uint8)
+        return np.ascontiguousarray(strip.reshape(cell_h, 128, cell_w, 3).transpose(1, 0, 2, 3))
+    
+    def _ensure_framebuffer(self) -> np.ndarray:
+        """Allocate the framebuffer for the current cols/rows if needed and return it."""
         img_width = self.cols * self.char_width + 20  # Add padding
         img_height = self.rows * (self.char_height + self.line_spacing) + 20  # Add padding
         
-        # Create a new image
-        img = Image.new('RGB', (img_width, img_height), color=self.bg_color)
-        draw = ImageDraw.Draw(img)
-        
-        # Draw each line of text
-        for row, line in enumerate(buffer):
-            y = 10 + row * (self.char_height + self.line_spacing)
+        if self._fb is None or self._fb.shape[:2] != (img_height, img_width):
+            self._fb = np.empty((img_height, img_width, 3), dtype=np.uint8)
+            self._fb[:] = self.bg_color
+            self._prev_buffer = []
             
-            # Draw the line
-            for col, char in enumerate(line):
-                x = 10 + col * self.char_width
-                
-                # Draw character
-                if char and char != ' ':
-                    try:
-                        draw.text((x, y), char, fill=self.fg_color, font=self.font)
-                    except Exception:
-                        # Fallback if font rendering fails
-                        draw.text((x, y), char, fill=self.fg_color)
-        
-        # Save to a temporary file
-        temp_dir = tempfile.gettempdir()
-        temp_file = os.path.join(temp_dir, "terminal_screenshot.png")
-        img.save(temp_file)
+            cell_h = self.char_height + self.line_spacing
+            self._row_ys = list(range(10, img_height - cell_h + 1, cell_h))
+            self._col_xs = list(range(10, img_width - self.char_width + 1, self.char_width))
+        
+        return self._fb
+    
+    def _draw_row(self, fb: np.ndarray, y: int, line: str):
+        """Clear the row strip at y and draw line into it."""
+        cell_h = self.char_height + self.line_spacing
+        strip = fb[y:y + cell_h]
+        strip[:] = self.bg_color
+        if not line or line.isspace():
+            return
+        
+        # Copy the row's cells out of the atlas in a single slice assignment
+        if line.isascii():
+            codes = np.frombuffer(line.encode('ascii'), dtype=np.uint8)
+        else:
+            # Characters outside the atlas get a blank cell and are drawn below
+            codes = np.fromiter(map(ord, line), dtype=np.uint32, count=len(line))
+        cells = self._glyphs[np.minimum(codes, 127)]
+        strip[:, 10:10 + len(line) * self.char_width] = cells.transpose(1, 0, 2, 3).reshape(cell_h, -1, 3)
+        
+        if line.isascii():
+            return
+        
+        row_img = Image.fromarray(strip, 'RGB')
+        draw = ImageDraw.Draw(row_img)
+        for x, char in zip(self._col_xs, line):
+            if char.isascii():
+                continue
+            try:
+                draw.text((x, 0), char, fill=self.fg_color, font=self.font)
+            except Exception:
+                # Fallback if font rendering fails
+                draw.text((x, 0), char, fill=self.fg_color)
+        strip[:] = np.asarray(row_img)
+    
+    def render(self, buffer: List[str], image_format: str = "png") -> str:
+        """Render the terminal buffer to an image file and return the path.
+
+        Each render writes a new file, which the caller owns and should delete.
+        """
+        image = self.render_bytes(buffer, image_format)
+        
+        # Save to a file unique to this call so concurrent renders cannot clobber each other
+        suffix = ".jpg" if image_format == "jpeg" else ".png"
+        fd, temp_file = tempfile.mkstemp(prefix="terminal_screenshot_", suffix=suffix)
+        with os.fdopen(fd, "wb") as f:
+            f.write(image)
         
         return temp_file
+    
+    def render_bytes(self, buffer: List[str], image_format: str = "png") -> bytes:
+        """Render the terminal buffer and return the encoded image.
+
+        Args:
+            buffer: Terminal lines, one per row
+            image_format: Image encoding, "png" (lossless) or "jpeg" (smaller and
+                faster to encode)
+
+        An unchanged buffer, size and format return the previous image without
+        rendering.
+        """
+        digest = xxhash.xxh3_64("\n".join(buffer).encode("utf-8", errors="replace"))
+        digest.update(f"\0{self.cols}x{self.rows}\0{image_format}".encode())
+        content_hash = digest.intdigest()
+        if content_hash == self._last_hash:
+            return self._last_image
+        
+        fb = self._ensure_framebuffer()
+        row_ys = self._row_ys
+        max_cols = len(self._col_xs)
+        lines = [line[:max_cols] for line in buffer[:len(row_ys)]]
+        
+        # Redraw only the rows that differ from what the framebuffer already shows
+        prev = self._prev_buffer
+        for row in range(max(len(lines), len(prev))):
+            line = lines[row] if row < len(lines) else ""
+            if line == (prev[row] if row < len(prev) else ""):
+                continue
+            self._draw_row(fb, row_ys[row], line)
+        self._prev_buffer = lines
+        
+        buf = io.BytesIO()
+        img = Image.fromarray(fb, 'RGB')
+        if image_format == "jpeg":
+            img.save(buf, format="JPEG", quality=JPEG_QUALITY)
+        else:
+            img.save(buf, format="PNG", optimize=False, compress_level=1)
+        
+        self._last_hash = content_hash
+        self._last_image = buf.getvalue()
+        return self._last_image
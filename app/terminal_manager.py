@@ -1,34 +1,82 @@
 import asyncio
+import logging
 import os
 import pty
 import signal
 import fcntl
 import struct
 import termios
-from typing import Dict, Optional, List
+from collections import deque
+from typing import Deque, Dict, Optional, List, Set, Tuple
 from fastapi import WebSocket
+import pyte
 import time
-from concurrent.futures import ThreadPoolExecutor
+
+from app.pyte_renderer import ScreenSnapshot, TerminalScreen
+
+
+logger = logging.getLogger(__name__)
+
+# Maximum bytes requested per PTY read. A Linux PTY master returns at most
+# 4095 bytes per read() whatever is asked, so this only avoids splitting reads
+# on platforms that hand out more; bursts are drained by reading until empty.
+PTY_READ_SIZE = 65536
+
+# Raw output kept for the browser renderer, which replays it per screenshot;
+# the oldest chunks are dropped once it holds more than this many bytes
+OUTPUT_BUFFER_BYTES = 4 * 1024 * 1024
+
+# PTY output arriving within this window is sent to clients as one message,
+# unless this much is already pending
+BROADCAST_FLUSH_INTERVAL = 0.005
+BROADCAST_FLUSH_BYTES = 16384
+
+# With more clients than this, broadcasts go out in batches of this size,
+# yielding to the event loop between batches
+BROADCAST_BATCH_SIZE = 50
 
 
 class TerminalManager:
     """Manages the pseudo-terminal (PTY) and WebSocket connections."""
     
-    def __init__(self):
+    def __init__(self, emulate_screen: bool = False):
         self.master_fd: Optional[int] = None
         self.slave_fd: Optional[int] = None
         self.process_pid: Optional[int] = None
-        self.connections: Dict[str, WebSocket] = {}
+        # Sockets to broadcast to, and each one's id for logging
+        self._conns: Set[WebSocket] = set()
+        self._ids: Dict[WebSocket, str] = {}
         self.connection_counter = 0
         self.read_task: Optional[asyncio.Task] = None
-        self.last_output_time = time.time()
+        self.last_output_time = time.monotonic()
         self.output_event = asyncio.Event()
-        self.executor = ThreadPoolExecutor(max_workers=1)
+        # PTY output not yet sent to clients; _flush_event is set once it is due
+        self._pending: List[bytes] = []
+        self._pending_size = 0
+        self._flush_event = asyncio.Event()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._pty_closed = False
+        # Set while reading is paused until the pending output has been sent
+        self._reader_paused = False
+        # Input the non-blocking PTY did not accept yet
+        self._write_buffer = bytearray()
         self.cols = 80
         self.rows = 24
-        # Buffer for terminal output (for screenshots without WebSocket)
-        self.output_buffer: List[str] = []
-        self.max_buffer_size = 10000  # Maximum lines to keep in buffer
+        # With emulate_screen, screenshots are drawn from a screen emulator that
+        # is fed only the output that arrived since the previous screenshot
+        self.screen: Optional[TerminalScreen] = None
+        self._screen_stream: Optional[pyte.ByteStream] = None
+        if emulate_screen:
+            self.screen = TerminalScreen(self.cols, self.rows)
+            self._screen_stream = pyte.ByteStream(self.screen)
+        # Buffer for raw terminal output (for screenshots without WebSocket)
+        self.output_buffer: Deque[bytes] = deque()
+        self._output_buffer_size = 0
+        # Bytes ever appended to output_buffer, and how many of them have been
+        # handed to the screen emulator
+        self._output_total = 0
+        self._screen_fed = 0
+        self.max_buffer_bytes = OUTPUT_BUFFER_BYTES
     
     async def start(self):
         """Start the PTY and spawn a shell process."""
@@ -66,18 +114,21 @@ class TerminalManager:
                 os.close(self.slave_fd)
                 self.slave_fd = None
                 
-                # Keep the master FD in blocking mode for reading in executor
-                # (Non-blocking mode would cause read() to return 0 immediately)
+                # Non-blocking master FD, serviced by the event loop's reader and
+                # writer callbacks instead of threads
+                os.set_blocking(self.master_fd, False)
                 
                 # Set initial terminal size
                 self.resize_pty(self.cols, self.rows)
                 
-                # Start the read task
+                # Read PTY output as soon as the kernel has some, and start the
+                # task that broadcasts it
+                asyncio.get_event_loop().add_reader(self.master_fd, self._on_pty_readable)
                 self.read_task = asyncio.create_task(self._read_from_pty_async())
                 
-                print(f"PTY started with PID {self.process_pid}")
+                logger.info("PTY started with PID %d", self.process_pid)
         except Exception as e:
-            print(f"Error starting PTY: {e}")
+            logger.error("Error starting PTY: %s", e)
             raise
     
     async def stop(self):
@@ -100,46 +151,71 @@ class TerminalManager:
             except ProcessLookupError:
                 pass
             except Exception as e:
-                print(f"Error terminating process: {e}")
+                logger.warning("Error terminating process: %s", e)
         
         if self.master_fd is not None:
+            loop = asyncio.get_event_loop()
+            loop.remove_reader(self.master_fd)
+            loop.remove_writer(self.master_fd)
             try:
                 os.close(self.master_fd)
             except OSError:
                 pass
         
-        self.executor.shutdown(wait=False)
-        print("PTY stopped")
+        logger.info("PTY stopped")
     
     def add_connection(self, websocket: WebSocket) -> str:
         """Add a WebSocket connection."""
         connection_id = f"conn_{self.connection_counter}"
         self.connection_counter += 1
-        self.connections[connection_id] = websocket
-        print(f"Connection added: {connection_id}")
+        self._conns.add(websocket)
+        self._ids[websocket] = connection_id
+        logger.info("Connection added: %s", connection_id)
         return connection_id
     
-    def remove_connection(self, connection_id: str):
+    def remove_connection(self, websocket: WebSocket):
         """Remove a WebSocket connection."""
-        if connection_id in self.connections:
-            del self.connections[connection_id]
-            print(f"Connection removed: {connection_id}")
+        if websocket in self._conns:
+            self._conns.discard(websocket)
+            logger.info("Connection removed: %s", self._ids.pop(websocket, None))
     
     async def write_to_pty(self, data: str):
         """Write data to the PTY."""
         if self.master_fd is None:
             return
         
+        data = data.encode('utf-8', errors='replace')
+        if self._write_buffer:
+            # Earlier input is still queued; keep the order
+            self._write_buffer += data
+            return
+        
         try:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                self.executor,
-                os.write,
-                self.master_fd,
-                data.encode('utf-8', errors='replace')
-            )
+            written = os.write(self.master_fd, data)
+        except BlockingIOError:
+            written = 0
         except OSError as e:
-            print(f"Error writing to PTY: {e}")
+            logger.error("Error writing to PTY: %s", e)
+            return
+        
+        if written < len(data):
+            # The PTY is full; send the rest once it becomes writable
+            self._write_buffer += data[written:]
+            asyncio.get_event_loop().add_writer(self.master_fd, self._on_pty_writable)
+    
+    def _on_pty_writable(self):
+        """Event loop callback: write queued input to the PTY."""
+        try:
+            written = os.write(self.master_fd, self._write_buffer)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logger.error("Error writing to PTY: %s", e)
+            written = len(self._write_buffer)
+        
+        del self._write_buffer[:written]
+        if not self._write_buffer:
+            asyncio.get_event_loop().remove_writer(self.master_fd)
     
     def resize_pty(self, cols: int, rows: int):
         """Resize the PTY."""
@@ -152,78 +228,131 @@ class TerminalManager:
             fcntl.ioctl(self.master_fd, termios.TIOCSWINSZ, s)
             self.cols = cols
             self.rows = rows
-            print(f"PTY resized to {cols}x{rows}")
+            logger.debug("PTY resized to %dx%d", cols, rows)
         except OSError as e:
-            print(f"Error resizing PTY: {e}")
+            logger.error("Error resizing PTY: %s", e)
     
-    def _read_blocking(self) -> bytes:
-        """Blocking read from PTY (to be run in executor)."""
-        try:
-            chunk = os.read(self.master_fd, 4096)
-            return chunk
-        except OSError:
-            return b""
+    def _on_pty_readable(self):
+        """Event loop callback: read PTY output, buffer it and queue it for clients.
+
+        Output is broadcast BROADCAST_FLUSH_INTERVAL after the first pending
+        chunk arrived, or once BROADCAST_FLUSH_BYTES are pending, so a burst
+        goes out as a few large messages. At BROADCAST_FLUSH_BYTES the reader
+        is also removed until the broadcast task has sent the output, so slow
+        clients stall the PTY instead of letting pending output grow.
+        """
+        # Read until the PTY has nothing left, so one wakeup takes a whole burst
+        got_output = False
+        while True:
+            try:
+                chunk = os.read(self.master_fd, PTY_READ_SIZE)
+            except BlockingIOError:
+                return
+            except OSError:
+                # EIO once the shell has exited
+                chunk = b""
+            
+            if not chunk:
+                # PTY closed
+                asyncio.get_event_loop().remove_reader(self.master_fd)
+                self._pty_closed = True
+                self._flush_event.set()
+                return
+            
+            # Store the raw bytes in the buffer for screenshots; they are
+            # decoded once, when the content is read
+            self.output_buffer.append(chunk)
+            self._output_buffer_size += len(chunk)
+            self._output_total += len(chunk)
+            # Trim the oldest output once the buffer exceeds max_buffer_bytes
+            while self._output_buffer_size > self.max_buffer_bytes:
+                self._output_buffer_size -= len(self.output_buffer.popleft())
+            
+            # Update the last output time, once per wakeup rather than per chunk
+            if not got_output:
+                got_output = True
+                self.last_output_time = time.monotonic()
+                if not self.output_event.is_set():
+                    self.output_event.set()
+            
+            # Queue for WebSocket clients, flushing once the window or size is reached
+            if not self._pending:
+                self._flush_handle = asyncio.get_event_loop().call_later(
+                    BROADCAST_FLUSH_INTERVAL, self._flush_event.set
+                )
+            self._pending.append(chunk)
+            self._pending_size += len(chunk)
+            if self._pending_size >= BROADCAST_FLUSH_BYTES:
+                # Stop reading until the broadcast task has sent it
+                asyncio.get_event_loop().remove_reader(self.master_fd)
+                self._reader_paused = True
+                self._flush_event.set()
+                return
     
     async def _read_from_pty_async(self):
-        """Continuously read from the PTY and broadcast to WebSocket clients."""
-        loop = asyncio.get_event_loop()
-        
+        """Broadcast PTY output queued by _on_pty_readable to WebSocket clients."""
         while True:
             try:
-                # Use executor to do blocking read
-                chunk = await loop.run_in_executor(self.executor, self._read_blocking)
+                # Output held back by _on_pty_readable has been sent; read again
+                if self._reader_paused and not self._pty_closed:
+                    self._reader_paused = False
+                    asyncio.get_event_loop().add_reader(self.master_fd, self._on_pty_readable)
                 
-                if not chunk:
-                    # PTY closed
-                    await self._broadcast("PTY closed\r\n")
-                    break
+                await self._flush_event.wait()
+                self._flush_event.clear()
+                if self._flush_handle is not None:
+                    self._flush_handle.cancel()
+                    self._flush_handle = None
                 
-                # Decode and process
-                text = chunk.decode('utf-8', errors='replace')
-
-                # Store in buffer for screenshots
-                self.output_buffer.append(text)
-                # Trim buffer if it gets too large (keep last max_buffer_size items)
-                if len(self.output_buffer) > self.max_buffer_size:
-                    self.output_buffer = self.output_buffer[-self.max_buffer_size:]
-
-                # Broadcast to WebSocket clients
-                await self._broadcast(text)
-
-                # Update the last output time
-                self.last_output_time = time.time()
-                self.output_event.set()
+                if self._pending:
+                    data = b''.join(self._pending)
+                    self._pending.clear()
+                    self._pending_size = 0
+                    await self._broadcast(data)
+                
+                if self._pty_closed:
+                    await self._broadcast(b"PTY closed\r\n")
+                    break
                 
             except asyncio.CancelledError:
                 break
             except Exception as e:
-                print(f"Error in read loop: {e}")
+                logger.error("Error in read loop: %s", e)
                 await asyncio.sleep(0.1)
     
-    async def _broadcast(self, data: str):
-        """Broadcast data to all connected WebSockets."""
-        if len(self.connections) > 0:
-            print(f"DEBUG: Broadcasting {len(data)} bytes to {len(self.connections)} connections: {repr(data[:50])}")
+    async def _broadcast(self, data: bytes):
+        """Broadcast raw PTY output to all connected WebSockets as binary frames."""
+        if self._conns and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Broadcasting %d bytes to %d connections: %r", len(data), len(self._conns), data[:50])
         
+        # Send to clients concurrently, so one slow socket doesn't delay the rest;
+        # large audiences are split into batches so other tasks get to run
+        sockets = tuple(self._conns)
         disconnected = []
         
-        for connection_id, websocket in self.connections.items():
-            try:
-                await websocket.send_text(data)
-            except Exception as e:
-                print(f"Error sending to {connection_id}: {e}")
-                disconnected.append(connection_id)
+        for start in range(0, len(sockets), BROADCAST_BATCH_SIZE):
+            if start:
+                await asyncio.sleep(0)
+            batch = sockets[start:start + BROADCAST_BATCH_SIZE]
+            results = await asyncio.gather(
+                *(websocket.send_bytes(data) for websocket in batch),
+                return_exceptions=True
+            )
+            for websocket, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.warning("Error sending to %s: %s", self._ids.get(websocket), result)
+                    disconnected.append(websocket)
         
         # Clean up disconnected connections
-        for connection_id in disconnected:
-            self.remove_connection(connection_id)
+        for websocket in disconnected:
+            self.remove_connection(websocket)
     
     async def wait_for_stable_output(self, timeout_seconds: int = 5):
         """Wait for the terminal output to stabilize."""
         stable_duration = 0.5  # Consider stable if no output for 500ms
-        start_time = time.time()
+        start_time = time.monotonic()
 
-        while time.time() - start_time < timeout_seconds:
+        while time.monotonic() - start_time < timeout_seconds:
             # Clear the event
             self.output_event.clear()
 
@@ -236,9 +365,46 @@ class TerminalManager:
                 return
 
             # Check if we've exceeded the total timeout
-            if time.time() - start_time >= timeout_seconds:
+            if time.monotonic() - start_time >= timeout_seconds:
                 return
 
+    def screen_backlog(self) -> Tuple[List[bytes], bool]:
+        """Take the output the screen emulator has not been fed yet.
+
+        Call on the event loop and pass the result to update_screen(). The flag
+        is True when part of that output was already trimmed from output_buffer;
+        the chunks are then the whole buffer, replayed onto a reset screen.
+        """
+        missing = self._output_total - self._screen_fed
+        self._screen_fed = self._output_total
+        if missing > self._output_buffer_size:
+            return list(self.output_buffer), True
+        
+        chunks = []
+        for chunk in reversed(self.output_buffer):
+            if missing <= 0:
+                break
+            chunks.append(chunk)
+            missing -= len(chunk)
+        chunks.reverse()
+        return chunks, False
+    
+    def update_screen(self, backlog: Tuple[List[bytes], bool]) -> ScreenSnapshot:
+        """Feed a screen_backlog() to the screen emulator and return a snapshot of it.
+
+        Runs in a worker thread, so the event loop never pays for emulation;
+        callers must not run two updates at once.
+        """
+        chunks, reset = backlog
+        if reset:
+            self.screen.reset()
+            self._screen_stream = pyte.ByteStream(self.screen)
+        # Output is emulated at the current size, as the browser renderer does
+        self.screen.resize(self.rows, self.cols)
+        for chunk in chunks:
+            self._screen_stream.feed(chunk)
+        return self.screen.snapshot()
+    
     def get_output_content(self) -> str:
         """Get the current buffered terminal output."""
-        return ''.join(self.output_buffer)
+        return b''.join(self.output_buffer).decode('utf-8', errors='replace')
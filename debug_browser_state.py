@@ -7,7 +7,7 @@ from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).parent))
 
-from app.browser_manager import BrowserManager
+from app.browser_manager import RENDER_JS, BrowserManager
 
 
 async def main():
@@ -15,25 +15,28 @@ async def main():
     print("Starting browser state debug...")
     
     browser_manager = BrowserManager()
+    page = None
     
     try:
         print("\n1. Starting browser...")
         await browser_manager.start()
         print("   ✓ Browser started")
         
-        print("\n2. Waiting for page load...")
-        await asyncio.sleep(3)
+        print("\n2. Renting a pooled page...")
+        page = await browser_manager._page_pool.get()
+        print("   ✓ Page rented")
         
         print("\n3. Checking page HTML...")
-        html = await browser_manager.page.content()
+        html = await page.content()
         print(f"   Page HTML length: {len(html)} bytes")
         print(f"   Contains 'Terminal': {'Terminal' in html}")
         print(f"   Contains 'xterm': {'xterm' in html}")
-        print(f"   Contains '/static/lib/xterm.js': {'/static/lib/xterm.js' in html}")
+        # xterm.js is inlined into the pooled pages, not fetched from the server
+        print(f"   Loads '/lib/xterm.js' over HTTP: {'/lib/xterm.js' in html}")
         
         print("\n4. Checking browser console logs...")
         try:
-            logs = await browser_manager.page.evaluate("""
+            logs = await page.evaluate("""
                 () => {
                     return {
                         hasTerminal: typeof Terminal !== 'undefined',
@@ -65,11 +68,17 @@ async def main():
                     'location': msg.location
                 })
             
-            browser_manager.page.on('console', on_message)
-            
-            # Trigger a reload to capture console messages
-            await browser_manager.page.reload(wait_until='networkidle')
-            await asyncio.sleep(2)
+            # Pooled pages are loaded with set_content, which a reload would
+            # throw away; set up a fresh page the same way, with the listener
+            # attached before anything runs
+            debug_page = await browser_manager.browsers[0].new_page()
+            debug_page.on('console', on_message)
+            try:
+                await debug_page.set_content(browser_manager._html, wait_until='domcontentloaded')
+                await debug_page.add_script_tag(content=RENDER_JS)
+                await debug_page.wait_for_selector('.xterm', timeout=5000)
+            finally:
+                await debug_page.close()
             
             if messages:
                 print(f"   Found {len(messages)} console messages:")
@@ -82,14 +91,14 @@ async def main():
         
         print("\n6. Checking page structure...")
         try:
-            body_html = await browser_manager.page.evaluate("() => document.body.innerHTML.substring(0, 500)")
+            body_html = await page.evaluate("() => document.body.innerHTML.substring(0, 500)")
             print(f"   Body HTML preview: {body_html}")
         except Exception as e:
             print(f"   Error getting body HTML: {e}")
         
         print("\n7. Checking all script tags...")
         try:
-            scripts = await browser_manager.page.evaluate("""
+            scripts = await page.evaluate("""
                 () => {
                     const scripts = document.querySelectorAll('script');
                     return Array.from(scripts).map(s => ({
@@ -107,10 +116,15 @@ async def main():
         except Exception as e:
             print(f"   Error checking scripts: {e}")
         
+        # Hand the page back so take_screenshot can rent it
+        await browser_manager._page_pool.put(page)
+        page = None
+        
         print("\n8. Taking screenshot...")
-        screenshot_path = await browser_manager.take_screenshot()
-        if screenshot_path:
-            print(f"   ✓ Screenshot saved to: {screenshot_path}")
+        image = await browser_manager.take_screenshot("$ echo debug\r\ndebug\r\n$ ")
+        screenshot_path = Path("debug_browser_state.png")
+        screenshot_path.write_bytes(image)
+        print(f"   ✓ Screenshot saved to: {screenshot_path}")
         
     except Exception as e:
         print(f"\n✗ Error: {e}")
@@ -118,6 +132,8 @@ async def main():
         traceback.print_exc()
     
     finally:
+        if page is not None:
+            await browser_manager._page_pool.put(page)
         print("\n9. Stopping browser...")
         await browser_manager.stop()
         print("   ✓ Browser stopped")
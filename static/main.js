@@ -30,9 +30,27 @@ fitAddon.fit();
 // Log terminal initialization
 console.log('Terminal initialized with dimensions:', terminal.cols, 'x', terminal.rows);
 
+// Client frames are binary: an opcode byte followed by the payload
+const WS_OP_INPUT = 0;
+const WS_OP_RESIZE = 1;
+const encoder = new TextEncoder();
+
+function sendInput(data) {
+    const payload = encoder.encode(data);
+    const frame = new Uint8Array(payload.length + 1);
+    frame[0] = WS_OP_INPUT;
+    frame.set(payload, 1);
+    ws.send(frame);
+}
+
+function sendResize(cols, rows) {
+    ws.send(new Uint8Array([WS_OP_RESIZE, cols >> 8, cols & 0xff, rows >> 8, rows & 0xff]));
+}
+
 // Establish WebSocket connection
 const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
 const ws = new WebSocket(`${protocol}//${window.location.host}/ws`);
+ws.binaryType = 'arraybuffer';
 
 ws.onopen = () => {
     console.log('WebSocket connected');
@@ -41,9 +59,10 @@ ws.onopen = () => {
 };
 
 ws.onmessage = (event) => {
-    // Receive data from the server and write it to the terminal
-    console.log('Received data:', event.data.length, 'bytes');
-    terminal.write(event.data);
+    // Receive raw PTY output from the server and write it to the terminal
+    const data = new Uint8Array(event.data);
+    console.log('Received data:', data.length, 'bytes');
+    terminal.write(data);
 };
 
 ws.onerror = (error) => {
@@ -60,7 +79,7 @@ ws.onclose = () => {
 terminal.onData((data) => {
     console.log('Sending data:', data.length, 'bytes');
     if (ws.readyState === WebSocket.OPEN) {
-        ws.send(data);
+        sendInput(data);
     } else {
         console.warn('WebSocket not open, cannot send data');
     }
@@ -74,7 +93,7 @@ const resizeObserver = new ResizeObserver(() => {
     
     // Send resize information to the server
     if (ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify({ type: 'resize', cols, rows }));
+        sendResize(cols, rows);
     }
 });
 
@@ -88,7 +107,7 @@ window.addEventListener('load', () => {
     console.log('Initial terminal size:', cols, 'x', rows);
     
     if (ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify({ type: 'resize', cols, rows }));
+        sendResize(cols, rows);
     }
 });
 
@@ -99,7 +118,7 @@ window.addEventListener('resize', () => {
     const { cols, rows } = terminal;
     
     if (ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify({ type: 'resize', cols, rows }));
+        sendResize(cols, rows);
     }
 });
 
@@ -1,39 +1,36 @@
 #!/usr/bin/env python3
 import asyncio
-import aiohttp
-import time
-from pathlib import Path
 
-BASE_URL = "http://localhost:8000"
+from tui_client import BASE_URL, CWD, JSON_HEADERS, MANUAL_RUN_PAYLOAD, WAIT_PAYLOAD, new_session, save_png
 
 async def main():
     print("Manual Workflow Test")
     print("=" * 50)
     
-    # Run a command
-    print("\n1. Running 'ls -la' command...")
-    async with aiohttp.ClientSession() as session:
-        payload = {"command": "ls -la\n"}
-        async with session.post(f"{BASE_URL}/mcp/run", json=payload) as resp:
+    async with new_session() as session:
+        # Run a command
+        print("\n1. Running 'ls -la' command...")
+        async with session.post(f"{BASE_URL}/mcp/run", data=MANUAL_RUN_PAYLOAD, headers=JSON_HEADERS) as resp:
             print(f"   Response: {resp.status}")
-    
-    # Wait longer for output
-    print("\n2. Waiting 5 seconds for output to be sent to browser...")
-    await asyncio.sleep(5)
-    
-    # Take screenshot
-    print("\n3. Taking screenshot...")
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{BASE_URL}/mcp/screenshot") as resp:
+        
+        # Wait until the output settles
+        print("\n2. Waiting for output to stabilize...")
+        async with session.post(f"{BASE_URL}/mcp/wait_for_stable_output", data=WAIT_PAYLOAD, headers=JSON_HEADERS) as resp:
+            if resp.status != 200:
+                print(f"   Wait failed: {resp.status}, sleeping instead")
+                await asyncio.sleep(1)
+        
+        # Take screenshot
+        print("\n3. Taking screenshot...")
+        async with session.get(f"{BASE_URL}/mcp/screenshot?format=png") as resp:
             if resp.status == 200:
-                data = await resp.read()
-                if data[:4] == b'\x89PNG':
-                    screenshot_path = Path("test_manual_workflow_screenshot.png")
-                    screenshot_path.write_bytes(data)
-                    print(f"   Screenshot saved: {screenshot_path.absolute()}")
+                screenshot_path = CWD / "test_manual_workflow_screenshot.png"
+                if await save_png(resp, screenshot_path) is not None:
+                    print(f"   Screenshot saved: {screenshot_path}")
                 else:
                     print("   Invalid PNG data")
             else:
                 print(f"   Failed: {resp.status}")
 
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,197 +2,314 @@
 """
 Test script for the TUI MCP Server.
 Verifies all endpoints and functionality.
+
+Run it directly (python test_server.py) or with pytest, optionally in
+parallel (pytest -n auto). Tests in the "terminal" xdist group drive the
+terminal in order; pytest.ini keeps them on a single worker.
 """
 
 import asyncio
 import aiohttp
-import json
-import time
+import os
 import sys
 from pathlib import Path
+from typing import Optional, Tuple
+
+import pytest
+import pytest_asyncio
+
+from tui_client import (
+    BASE_URL, CWD, JSON_HEADERS, PNG_SIGNATURE, RUN_PAYLOAD, SEND_KEYS_PAYLOAD,
+    SETTLE_PAYLOAD, WAIT_PAYLOAD, WORKFLOW_RUN_PAYLOAD, new_session, save_png,
+)
+
 
+# TEST_QUIET=1 skips reading JSON response bodies that would only be printed
+QUIET = os.environ.get("TEST_QUIET") == "1"
 
-BASE_URL = "http://localhost:8000"
+
+async def _check(
+    session: aiohttp.ClientSession,
+    method: str,
+    path: str,
+    label: str,
+    *,
+    body: Optional[bytes] = None,
+    save_to: Optional[Path] = None,
+) -> Tuple[bool, str]:
+    """Request an endpoint and expect a 200; return (ok, log line).
+
+    body is a pre-serialized JSON request body. With save_to, the response
+    must be a PNG and is saved there; otherwise the JSON response body is
+    included in the log line, unless QUIET is set.
+    """
+    headers = JSON_HEADERS if body is not None else None
+    async with session.request(method, f"{BASE_URL}{path}", data=body, headers=headers) as resp:
+        if resp.status != 200:
+            return False, f"✗ {label} failed: {resp.status}"
+        
+        if save_to is None:
+            if QUIET:
+                # Hand the connection back to the pool without reading the body
+                resp.release()
+                return True, f"✓ {label}"
+            data = await resp.json()
+            return True, f"✓ {label}: {data}"
+        
+        size = await save_png(resp, save_to)
+        if size is None:
+            return False, f"✗ {label}: invalid PNG data received"
+        return True, f"✓ {label}: {size} bytes\n  Saved to: {save_to}"
 
 
-async def test_health():
+async def _settle(session: aiohttp.ClientSession):
+    """Block until the command just sent has finished printing; the response is ignored."""
+    async with session.post(
+        f"{BASE_URL}/mcp/wait_for_stable_output", data=SETTLE_PAYLOAD, headers=JSON_HEADERS
+    ):
+        pass
+
+
+async def check_health(session: aiohttp.ClientSession) -> Tuple[bool, str]:
     """Test the health endpoint."""
-    print("\n=== Testing Health Endpoint ===")
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{BASE_URL}/health") as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                print(f"✓ Health check passed: {data}")
-                return True
-            else:
-                print(f"✗ Health check failed: {resp.status}")
-                return False
-
-
-async def test_run_command():
+    return await _check(session, "GET", "/health", "Health check passed")
+
+
+async def check_run_command(session: aiohttp.ClientSession) -> Tuple[bool, str]:
     """Test the /mcp/run endpoint."""
-    print("\n=== Testing /mcp/run Endpoint ===")
-    async with aiohttp.ClientSession() as session:
-        payload = {"command": "echo 'Hello from TUI MCP Server'"}
-        async with session.post(f"{BASE_URL}/mcp/run", json=payload) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                print(f"✓ Command sent: {data}")
-                await asyncio.sleep(1)  # Wait for output
-                return True
-            else:
-                print(f"✗ Command failed: {resp.status}")
-                return False
-
-
-async def test_wait_for_stable_output():
+    result = await _check(session, "POST", "/mcp/run", "Command sent", body=RUN_PAYLOAD)
+    await _settle(session)
+    return result
+
+
+async def check_wait_for_stable_output(session: aiohttp.ClientSession) -> Tuple[bool, str]:
     """Test the /mcp/wait_for_stable_output endpoint."""
-    print("\n=== Testing /mcp/wait_for_stable_output Endpoint ===")
-    async with aiohttp.ClientSession() as session:
-        payload = {"timeout_seconds": 5}
-        async with session.post(f"{BASE_URL}/mcp/wait_for_stable_output", json=payload) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                print(f"✓ Output stabilized: {data}")
-                return True
-            else:
-                print(f"✗ Wait failed: {resp.status}")
-                return False
-
-
-async def test_screenshot():
+    return await _check(session, "POST", "/mcp/wait_for_stable_output", "Output stabilized", body=WAIT_PAYLOAD)
+
+
+async def check_screenshot(session: aiohttp.ClientSession) -> Tuple[bool, str]:
     """Test the /mcp/screenshot endpoint."""
-    print("\n=== Testing /mcp/screenshot Endpoint ===")
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{BASE_URL}/mcp/screenshot") as resp:
-            if resp.status == 200:
-                data = await resp.read()
-                # Check if it's a valid PNG (PNG signature: 89 50 4E 47)
-                if data[:4] == b'\x89PNG':
-                    screenshot_path = Path("test_screenshot.png")
-                    screenshot_path.write_bytes(data)
-                    print(f"✓ Screenshot captured: {len(data)} bytes")
-                    print(f"  Saved to: {screenshot_path.absolute()}")
-                    return True
-                else:
-                    print(f"✗ Invalid PNG data received")
-                    return False
-            else:
-                print(f"✗ Screenshot failed: {resp.status}")
-                return False
-
-
-async def test_send_keys():
+    return await _check(
+        session, "GET", "/mcp/screenshot?format=png", "Screenshot captured",
+        save_to=CWD / "test_screenshot.png",
+    )
+
+
+async def check_screenshot_etag(session: aiohttp.ClientSession) -> Tuple[bool, str]:
+    """Test the screenshot's default format, its ETag and revalidating it."""
+    url = f"{BASE_URL}/mcp/screenshot"
+    lines = []
+    
+    async with session.get(url) as resp:
+        if resp.status != 200:
+            return False, f"✗ Screenshot failed: {resp.status}"
+        body = await resp.read()
+        etag = resp.headers.get("ETag")
+        if resp.content_type != "image/png" or not body.startswith(PNG_SIGNATURE):
+            return False, f"✗ Default screenshot is {resp.content_type}, expected a PNG"
+        if not etag:
+            return False, "✗ Screenshot has no ETag header"
+    lines.append(f"✓ Default screenshot is a PNG with ETag {etag}")
+    
+    # The terminal is unchanged, so the same ETag must revalidate
+    async with session.get(url, headers={"If-None-Match": etag}) as resp:
+        if resp.status != 304:
+            return False, "\n".join(lines + [f"✗ Revalidation returned {resp.status}, expected 304"])
+    lines.append("✓ Unchanged screenshot revalidated: 304 Not Modified")
+    
+    async with session.get(f"{url}?format=jpeg", headers={"If-None-Match": etag}) as resp:
+        await resp.read()
+        if resp.status != 200 or resp.content_type != "image/jpeg":
+            return False, "\n".join(lines + [f"✗ JPEG screenshot returned {resp.status} {resp.content_type}"])
+    lines.append("✓ format=jpeg returns image/jpeg under its own ETag")
+    return True, "\n".join(lines)
+
+
+async def check_send_keys(session: aiohttp.ClientSession) -> Tuple[bool, str]:
     """Test the /mcp/send_keys endpoint."""
-    print("\n=== Testing /mcp/send_keys Endpoint ===")
-    async with aiohttp.ClientSession() as session:
-        # Send a simple command via send_keys
-        payload = {"keys": "echo 'Keys sent successfully'\n"}
-        async with session.post(f"{BASE_URL}/mcp/send_keys", json=payload) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                print(f"✓ Keys sent: {data}")
-                await asyncio.sleep(1)  # Wait for output
-                return True
-            else:
-                print(f"✗ Send keys failed: {resp.status}")
-                return False
-
-
-async def test_interactive_workflow():
+    # Send a simple command via send_keys
+    result = await _check(session, "POST", "/mcp/send_keys", "Keys sent", body=SEND_KEYS_PAYLOAD)
+    await _settle(session)
+    return result
+
+
+async def check_interactive_workflow(session: aiohttp.ClientSession) -> Tuple[bool, str]:
     """Test a complete interactive workflow."""
-    print("\n=== Testing Complete Interactive Workflow ===")
+    steps = [
+        ("1. Running command: 'ls -la'",
+         ("POST", "/mcp/run", "Command sent"), {"body": WORKFLOW_RUN_PAYLOAD}),
+        ("2. Waiting for output to stabilize...",
+         ("POST", "/mcp/wait_for_stable_output", "Output stabilized"), {"body": WAIT_PAYLOAD}),
+        ("3. Taking screenshot...",
+         ("GET", "/mcp/screenshot?format=png", "Screenshot saved"), {"save_to": CWD / "test_workflow_screenshot.png"}),
+    ]
+    lines = []
     
     try:
-        # 1. Run a command
-        print("\n1. Running command: 'ls -la'")
-        async with aiohttp.ClientSession() as session:
-            payload = {"command": "ls -la"}
-            async with session.post(f"{BASE_URL}/mcp/run", json=payload) as resp:
-                if resp.status != 200:
-                    print("✗ Failed to run command")
-                    return False
-        
-        # 2. Wait for output
-        print("2. Waiting for output to stabilize...")
-        async with aiohttp.ClientSession() as session:
-            payload = {"timeout_seconds": 5}
-            async with session.post(f"{BASE_URL}/mcp/wait_for_stable_output", json=payload) as resp:
-                if resp.status != 200:
-                    print("✗ Failed to wait for stable output")
-                    return False
-        
-        # 3. Take screenshot
-        print("3. Taking screenshot...")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{BASE_URL}/mcp/screenshot") as resp:
-                if resp.status != 200:
-                    print("✗ Failed to take screenshot")
-                    return False
-                data = await resp.read()
-                if data[:4] != b'\x89PNG':
-                    print("✗ Invalid PNG data")
-                    return False
-                screenshot_path = Path("test_workflow_screenshot.png")
-                screenshot_path.write_bytes(data)
-                print(f"✓ Screenshot saved to: {screenshot_path.absolute()}")
-        
-        print("\n✓ Complete workflow test passed!")
-        return True
-    
+        for title, args, kwargs in steps:
+            lines.append(title)
+            ok, line = await _check(session, *args, **kwargs)
+            lines.append(line)
+            if not ok:
+                return False, "\n".join(lines)
     except Exception as e:
-        print(f"✗ Workflow test failed: {e}")
-        return False
+        lines.append(f"✗ Workflow test failed: {e}")
+        return False, "\n".join(lines)
+    
+    lines.append("\n✓ Complete workflow test passed!")
+    return True, "\n".join(lines)
+
+
+async def wait_for_server(session: aiohttp.ClientSession) -> Optional[str]:
+    """Poll /health with backoff in case the server is still starting; return the last error, or None once it is up."""
+    error = None
+    for delay in (0.05, 0.1, 0.2, 0.4, 0.8, 1.6):
+        try:
+            async with session.get(f"{BASE_URL}/health", timeout=aiohttp.ClientTimeout(total=1)) as resp:
+                if resp.status == 200:
+                    return None
+                error = f"HTTP {resp.status}"
+        except Exception as e:
+            error = str(e)
+        await asyncio.sleep(delay)
+    return error
+
+
+# pytest entry points. The "terminal" group drives the shared terminal and relies
+# on running in file order after one another, so it must stay on one worker.
+
+@pytest.fixture(scope="session")
+def event_loop():
+    """One event loop for the whole run, shared by the session fixture and every test."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest_asyncio.fixture(scope="session")
+async def session():
+    """The shared HTTP session; skips every test when the server isn't running."""
+    session = new_session()
+    error = await wait_for_server(session)
+    if error is not None:
+        await session.close()
+        pytest.skip(f"Server is not running at {BASE_URL}: {error}")
+    yield session
+    await session.close()
+
+
+@pytest.mark.asyncio
+async def test_health(session: aiohttp.ClientSession):
+    ok, log = await check_health(session)
+    assert ok, log
+
+
+@pytest.mark.asyncio
+async def test_screenshot(session: aiohttp.ClientSession):
+    ok, log = await check_screenshot(session)
+    assert ok, log
+
+
+@pytest.mark.xdist_group("terminal")
+@pytest.mark.asyncio
+async def test_run_command(session: aiohttp.ClientSession):
+    ok, log = await check_run_command(session)
+    assert ok, log
+
+
+@pytest.mark.xdist_group("terminal")
+@pytest.mark.asyncio
+async def test_wait_for_stable_output(session: aiohttp.ClientSession):
+    ok, log = await check_wait_for_stable_output(session)
+    assert ok, log
+
+
+@pytest.mark.xdist_group("terminal")
+@pytest.mark.asyncio
+async def test_screenshot_etag(session: aiohttp.ClientSession):
+    ok, log = await check_screenshot_etag(session)
+    assert ok, log
+
+
+@pytest.mark.xdist_group("terminal")
+@pytest.mark.asyncio
+async def test_send_keys(session: aiohttp.ClientSession):
+    ok, log = await check_send_keys(session)
+    assert ok, log
+
+
+@pytest.mark.xdist_group("terminal")
+@pytest.mark.asyncio
+async def test_interactive_workflow(session: aiohttp.ClientSession):
+    ok, log = await check_interactive_workflow(session)
+    assert ok, log
 
 
 async def main():
-    """Run all tests."""
-    print("=" * 50)
-    print("TUI MCP Server Test Suite")
-    print("=" * 50)
+    """Run all tests without pytest."""
+    session = new_session()
+    try:
+        await run_tests(session)
+    finally:
+        await session.close()
+
+
+async def run_tests(session: aiohttp.ClientSession):
+    """Check the server is up, run the tests and print a summary."""
+    sys.stdout.write("\n".join(["=" * 50, "TUI MCP Server Test Suite", "=" * 50]) + "\n")
     
     # Check if server is running
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{BASE_URL}/health", timeout=aiohttp.ClientTimeout(total=2)) as resp:
-                pass
-    except Exception as e:
-        print(f"\n✗ Server is not running at {BASE_URL}")
-        print(f"  Error: {e}")
-        print(f"\n  Start the server with:")
-        print(f"  python -m uvicorn app.main:app --host 0.0.0.0 --port 8000")
+    error = await wait_for_server(session)
+    if error is not None:
+        sys.stdout.write("\n".join([
+            f"\n✗ Server is not running at {BASE_URL}",
+            f"  Error: {error}",
+            "\n  Start the server with:",
+            "  python -m uvicorn app.main:app --host 0.0.0.0 --port 8000",
+        ]) + "\n")
         sys.exit(1)
     
-    # Run tests
+    # Run tests: the ones that don't depend on terminal state run concurrently,
+    # then the ones that drive the terminal run in order. Each test's log is
+    # written in one call once it finishes, so concurrent tests never interleave output.
     results = []
     
-    results.append(("Health Check", await test_health()))
-    results.append(("Run Command", await test_run_command()))
-    results.append(("Wait for Stable Output", await test_wait_for_stable_output()))
-    results.append(("Send Keys", await test_send_keys()))
-    results.append(("Screenshot", await test_screenshot()))
-    results.append(("Complete Workflow", await test_interactive_workflow()))
+    def report(test_name: str, outcome):
+        if isinstance(outcome, Exception):
+            outcome = (False, f"✗ {test_name} raised: {outcome}")
+        ok, log = outcome
+        sys.stdout.write(f"\n=== {test_name} ===\n{log}\n")
+        results.append((test_name, ok))
     
-    # Print summary
-    print("\n" + "=" * 50)
-    print("Test Summary")
-    print("=" * 50)
+    health, screenshot = await asyncio.gather(
+        check_health(session),
+        check_screenshot(session),
+        return_exceptions=True
+    )
+    report("Health Check", health)
+    report("Screenshot", screenshot)
+    report("Run Command", await check_run_command(session))
+    report("Wait for Stable Output", await check_wait_for_stable_output(session))
+    report("Screenshot ETag", await check_screenshot_etag(session))
+    report("Send Keys", await check_send_keys(session))
+    report("Complete Workflow", await check_interactive_workflow(session))
     
+    # Print summary
     passed = sum(1 for _, result in results if result)
     total = len(results)
     
+    lines = ["\n" + "=" * 50, "Test Summary", "=" * 50]
     for test_name, result in results:
         status = "✓ PASS" if result else "✗ FAIL"
-        print(f"{status}: {test_name}")
-    
-    print(f"\nTotal: {passed}/{total} tests passed")
+        lines.append(f"{status}: {test_name}")
     
+    lines.append(f"\nTotal: {passed}/{total} tests passed")
     if passed == total:
-        print("\n✓ All tests passed!")
-        sys.exit(0)
+        lines.append("\n✓ All tests passed!")
     else:
-        print(f"\n✗ {total - passed} test(s) failed")
-        sys.exit(1)
+        lines.append(f"\n✗ {total - passed} test(s) failed")
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.exit(0 if passed == total else 1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+"""HTTP client helpers shared by the TUI MCP Server test scripts."""
+
+import asyncio
+import aiohttp
+from pathlib import Path
+from typing import Optional
+
+
+# A literal loopback address, so connections skip resolving "localhost"
+BASE_URL = "http://127.0.0.1:8000"
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Screenshots are saved here; resolved once rather than per saved file
+CWD = Path.cwd()
+
+# Applies to every request, so a stuck server fails a test instead of
+# hanging it; wait_for_stable_output blocks for up to 5s
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=2, sock_read=8)
+
+# Request bodies are fixed, so they are serialized once here
+JSON_HEADERS = {"Content-Type": "application/json"}
+RUN_PAYLOAD = b'{"command": "echo \'Hello from TUI MCP Server\'"}'
+WORKFLOW_RUN_PAYLOAD = b'{"command": "ls -la"}'
+MANUAL_RUN_PAYLOAD = b'{"command": "ls -la\\n"}'
+WAIT_PAYLOAD = b'{"timeout_seconds": 5}'
+SETTLE_PAYLOAD = b'{"timeout_seconds": 2}'
+SEND_KEYS_PAYLOAD = b'{"keys": "echo \'Keys sent successfully\'\\n"}'
+
+
+def new_session() -> aiohttp.ClientSession:
+    """Create the HTTP session shared by a whole test run, so requests reuse keep-alive connections."""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=64, keepalive_timeout=30, ttl_dns_cache=3600),
+        timeout=DEFAULT_TIMEOUT,
+    )
+
+
+async def save_png(resp: aiohttp.ClientResponse, path: Path) -> Optional[int]:
+    """Stream a PNG response body to path; return its size, or None if it isn't a PNG."""
+    try:
+        header = await resp.content.readexactly(8)
+    except asyncio.IncompleteReadError:
+        return None
+    # Check the full 8-byte PNG signature
+    if header != PNG_SIGNATURE:
+        return None
+    
+    size = len(header)
+    with path.open("wb") as f:
+        f.write(header)
+        async for chunk in resp.content.iter_chunked(65536):
+            f.write(chunk)
+            size += len(chunk)
+    return size